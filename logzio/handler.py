@@ -2,12 +2,20 @@ import datetime
 import json
 import logging
 import logging.handlers
-import sys
 import traceback
 
 from .exceptions import LogzioException
 from .sender import LogzioSender
 
+# LogRecord attributes that are never shipped as extra fields
+NOT_ALLOWED_KEYS = frozenset((
+    'args', 'asctime', 'created', 'exc_info', 'stack_info', 'exc_text',
+    'filename', 'funcName', 'levelname', 'levelno', 'lineno', 'module',
+    'msecs', 'message', 'msg', 'name', 'pathname', 'process',
+    'processName', 'relativeCreated', 'thread', 'threadName'))
+
+VAR_TYPE = (str, bool, dict, float, int, list, type(None))
+
 
 class ExtraFieldsLogFilter(logging.Filter):
 
@@ -64,25 +72,11 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
         del self.logzio_sender
 
     def extra_fields(self, message):
-
-        not_allowed_keys = (
-            'args', 'asctime', 'created', 'exc_info', 'stack_info', 'exc_text',
-            'filename', 'funcName', 'levelname', 'levelno', 'lineno', 'module',
-            'msecs', 'msecs', 'message', 'msg', 'name', 'pathname', 'process',
-            'processName', 'relativeCreated', 'thread', 'threadName')
-
-        if sys.version_info < (3, 0):
-            # long and basestring don't exist in py3 so, NOQA
-            var_type = (basestring, bool, dict, float,  # NOQA
-                        int, long, list, type(None))  # NOQA
-        else:
-            var_type = (str, bool, dict, float, int, list, type(None))
-
         extra_fields = {}
 
         for key, value in message.__dict__.items():
-            if key not in not_allowed_keys:
-                if isinstance(value, var_type):
+            if key not in NOT_ALLOWED_KEYS:
+                if isinstance(value, VAR_TYPE):
                     extra_fields[key] = value
                 else:
                     extra_fields[key] = repr(value)
@@ -92,6 +86,10 @@ pip install 'logzio-python-handler[opentelemetry-logging]'""")
     def flush(self):
         self.logzio_sender.flush()
 
+    def close(self):
+        self.logzio_sender.close()
+        super().close()
+
     def format(self, record):
         message = super(LogzioHandler, self).format(record)
         try:
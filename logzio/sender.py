@@ -1,39 +1,132 @@
 # This class is responsible for handling all asynchronous Logz.io's
 # communication
+import atexit
+import gzip
 import json
-import sys
-from datetime import datetime
+import os
+import weakref
+from collections import deque
+from datetime import date, datetime
+from decimal import Decimal
 from importlib.metadata import version
-from threading import Thread, enumerate
-from time import sleep
+from random import random
+from threading import Event, Thread, current_thread
+from time import monotonic, sleep
+from uuid import UUID
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from .logger import get_stdout_logger
 
-if sys.version[0] == '2':
-    import Queue as queue
-else:
-    import queue as queue
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 PACKAGE_NAME = "logzio-python-handler"
 PACKAGE_VERSION = version(PACKAGE_NAME)
 SHIPPER_HEADER = {"user-agent": f"{PACKAGE_NAME}-version-{PACKAGE_VERSION}-logs"}
-MAX_BULK_SIZE_IN_BYTES = 1 * 1024 * 1024  # 1 MB
+MAX_BULK_SIZE_IN_BYTES = 1 * 1024 * 1024  # 1 MB, before compression
+MAX_RETRY_BACKOFF_IN_SECONDS = 30
+
+
+# Conversions of the types JSON can't represent, looked up by exact type
+JSON_CONVERTERS = {
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+    UUID: str,
+    Decimal: str,
+}
+
+
+def _get_json_converter(o):
+    convert = JSON_CONVERTERS.get(type(o))
+    if convert is None:
+        # Subclasses miss the exact lookup, datetime is checked before date
+        for cls, cls_convert in JSON_CONVERTERS.items():
+            if isinstance(o, cls):
+                return cls_convert
+    return convert
 
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat()
+        convert = _get_json_converter(o)
+        if convert is not None:
+            return convert(o)
         return super().default(o)
 
 
+def _default(o):
+    # orjson handles most of these natively, it only falls back to us for
+    # subclasses and types such as Decimal
+    convert = _get_json_converter(o)
+    if convert is not None:
+        return convert(o)
+    raise TypeError('Type is not JSON serializable: {}'.format(
+        type(o).__name__))
+
+
+def _json_dumps(logs_message):
+    return json.dumps(logs_message, cls=CustomJSONEncoder).encode('utf-8')
+
+
+if orjson is not None:
+    def json_dumps(logs_message):
+        try:
+            return orjson.dumps(logs_message, default=_default,
+                                option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, which json handles
+            return _json_dumps(logs_message)
+else:
+    json_dumps = _json_dumps
+
+
 def backup_logs(logs, logger):
     timestamp = datetime.now().strftime('%d%m%Y-%H%M%S')
     logger.info(
         'Backing up your logs to logzio-failures-%s.txt', timestamp)
-    with open('logzio-failures-{}.txt'.format(timestamp), 'a') as f:
-        f.writelines('\n'.join(logs))
+    # Written log by log through a 1 MB buffer, instead of joining the bulk
+    with open('logzio-failures-{}.txt'.format(timestamp), 'ab',
+              buffering=1 << 20) as f:
+        for log in logs:
+            f.write(log)
+            f.write(b'\n')
+
+
+def gzip_logs(logs):
+    # A single compress call over the joined bulk is much faster than
+    # feeding the logs one by one. Fastest level, most of the gain comes from
+    # repetitive keys
+    return gzip.compress(b'\n'.join(logs), compresslevel=1)
+
+
+# Live senders, their sending threads need care on fork and exit
+_senders = weakref.WeakSet()
+
+
+def _restart_sending_threads():
+    # Only the forking thread survives in the child, the events may hold
+    # lock and waiter state of the parent's sending thread
+    for sender in list(_senders):
+        if not sender._closed.is_set():
+            sender._wakeup = Event()
+            sender._closed = Event()
+            sender._initialize_sending_thread()
+
+
+def _close_senders():
+    # Sending threads are daemons, drain them before the interpreter exits
+    for sender in list(_senders):
+        if not sender._closed.is_set():
+            sender.close()
+
+
+atexit.register(_close_senders)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_sending_threads)
 
 
 class LogzioSender:
@@ -44,7 +137,9 @@ class LogzioSender:
                  backup_logs=True,
                  network_timeout=10.0,
                  number_of_retries=4,
-                 retry_timeout=2):
+                 retry_timeout=2,
+                 encoder=None,
+                 max_queue_size=None):
         self.token = token
         self.url = '{}/?token={}'.format(url, token)
         self.logs_drain_timeout = logs_drain_timeout
@@ -52,48 +147,91 @@ class LogzioSender:
         self.backup_logs = backup_logs
         self.network_timeout = network_timeout
         self.requests_session = requests.Session()
+        self.requests_session.headers.update({
+            "Content-type": "text/plain",
+            "Content-Encoding": "gzip",
+            **SHIPPER_HEADER})
+        # All bulks go to a single listener, from the sending thread or from
+        # flush(), a small pool keeps those connections alive between bulks
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.requests_session.mount('https://', adapter)
+        self.requests_session.mount('http://', adapter)
         self.number_of_retries = number_of_retries
         self.retry_timeout = retry_timeout
+        # Callable serializing a single log message to JSON, str or bytes
+        self.encoder = encoder or json_dumps
 
-        # Function to see if the main thread is alive
-        self.is_main_thread_active = lambda: any(
-            (i.name == 'MainThread') and i.is_alive() for i in enumerate())
-
-        # Create a queue to hold logs
-        self.queue = queue.Queue()
+        # Create a queue to hold logs, appends and pops are thread safe.
+        # When bounded, the oldest logs are dropped once it is full
+        self.queue = deque(maxlen=max_queue_size)
+        # Set whenever logs are appended, so they are drained right away
+        self._wakeup = Event()
+        # Set by close(), also bounds the wait between retries by the time
+        # left until its timeout
+        self._closed = Event()
+        self._close_deadline = None
+        self._status_handlers = {
+            200: self._handle_ok,
+            400: self._handle_bad_request,
+            401: self._handle_unauthorized,
+        }
         self._initialize_sending_thread()
-
-    def __del__(self):
-        del self.stdout_logger
-        del self.backup_logs
-        del self.queue
+        _senders.add(self)
 
     def _initialize_sending_thread(self):
         self.sending_thread = Thread(target=self._drain_queue)
-        self.sending_thread.daemon = False
+        self.sending_thread.daemon = True
         self.sending_thread.name = 'logzio-sending-thread'
         self.sending_thread.start()
 
     def append(self, logs_message):
-        if not self.sending_thread.is_alive():
-            self._initialize_sending_thread()
-
-        # Queue lib is thread safe, no issue here
-        self.queue.put(json.dumps(logs_message, cls=CustomJSONEncoder))
+        payload = self.encoder(logs_message)
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if len(payload) > MAX_BULK_SIZE_IN_BYTES:
+            # Would be rejected by Logz.io, along with the rest of its bulk
+            self.stdout_logger.warning(
+                'Dropping log of %s bytes, larger than the maximum bulk size '
+                'of %s bytes', len(payload), MAX_BULK_SIZE_IN_BYTES)
+            return
+        if len(self.queue) == self.queue.maxlen:
+            # Debug only, this happens for every log while the queue is full
+            self.stdout_logger.debug(
+                'Logs queue is full (%s logs), dropping the oldest log',
+                self.queue.maxlen)
+        self.queue.append(payload)
+        self._wakeup.set()
 
     def flush(self):
         self._flush_queue()
 
+    def close(self, timeout=None):
+        # Let the sending thread drain the queue one last time and exit
+        if timeout is not None:
+            self._close_deadline = monotonic() + timeout
+        self._closed.set()
+        self._wakeup.set()
+        if self.sending_thread is not current_thread():
+            self.sending_thread.join(timeout)
+            if not self.sending_thread.is_alive():
+                # The thread may have made its last try earlier, when the
+                # main thread exited, send what other threads queued since
+                self._flush_queue()
+        self.requests_session.close()
+
     def _drain_queue(self):
+        # The thread is a daemon, it keeps draining until close(), even after
+        # the main thread exits, as non-daemon threads may still log
         last_try = False
 
         while not last_try:
-            # If main is exited, we should run one last time and try to remove
-            # all logs
-            if not self.is_main_thread_active():
+            # Cleared before checking for close and draining, so close() or
+            # logs appended meanwhile wake us up
+            self._wakeup.clear()
+
+            if self._closed.is_set():
                 self.stdout_logger.debug(
-                    'Identified quit of main thread, sending logs one '
-                    'last time')
+                    'Sender was closed, sending logs one last time')
                 last_try = True
 
             try:
@@ -104,56 +242,27 @@ class LogzioSender:
                     'swallowing. Exception: %s', e)
 
             if not last_try:
-                sleep(self.logs_drain_timeout)
+                self._wakeup.wait(timeout=self.logs_drain_timeout)
 
     def _flush_queue(self):
-        # Sending logs until queue is empty
-        while not self.queue.empty():
-            logs_list = self._get_messages_up_to_max_allowed_size()
+        for logs_list in self._get_bulks(self._pop_queued_logs()):
             self.stdout_logger.debug(
                 'Starting to drain %s logs to Logz.io', len(logs_list))
 
-            # Not configurable from the outside
-            sleep_between_retries = self.retry_timeout
-            self.number_of_retries = self.number_of_retries
-
             should_backup_to_disk = True
-            headers = {"Content-type": "text/plain", **SHIPPER_HEADER}
+            body = gzip_logs(logs_list)
 
-            for current_try in range(self.number_of_retries):
-                should_retry = False
+            current_try = 0
+            out_of_close_time = False
+            while True:
                 try:
                     response = self.requests_session.post(
-                        self.url, headers=headers, data='\n'.join(logs_list),
+                        self.url, data=body,
                         timeout=self.network_timeout)
-                    if response.status_code != 200:
-                        if response.status_code == 400:
-                            self.stdout_logger.info(
-                                'Got 400 code from Logz.io. This means that '
-                                'some of your logs are too big, or badly '
-                                'formatted. response: %s', response.text)
-                            should_backup_to_disk = False
-                            break
-
-                        if response.status_code == 401:
-                            self.stdout_logger.info(
-                                'You are not authorized with Logz.io! Token '
-                                'OK? dropping logs...')
-                            should_backup_to_disk = False
-                            break
-                        else:
-                            self.stdout_logger.info(
-                                'Got %s while sending logs to Logz.io, '
-                                'Try (%s/%s). Response: %s',
-                                response.status_code,
-                                current_try + 1,
-                                self.number_of_retries,
-                                response.text)
-                            should_retry = True
-                    else:
-                        self.stdout_logger.debug(
-                            'Successfully sent bulk of %s logs to '
-                            'Logz.io!', len(logs_list))
+                    handler = self._status_handlers.get(
+                        response.status_code, self._handle_retry)
+                    # Handlers return True once the bulk needs no more tries
+                    if handler(response, logs_list, current_try):
                         should_backup_to_disk = False
                         break
                 except Exception as e:
@@ -161,32 +270,88 @@ class LogzioSender:
                         'Got exception while sending logs to Logz.io, '
                         'Try (%s/%s). Message: %s',
                         current_try + 1, self.number_of_retries, e)
-                    should_retry = True
 
-                if should_retry:
-                    sleep(sleep_between_retries)
+                current_try += 1
+                # Past close()'s timeout the bulk gets one last try
+                if current_try >= self.number_of_retries or \
+                        out_of_close_time:
+                    break
+                out_of_close_time = not self._wait_before_retry(current_try)
 
             if should_backup_to_disk and self.backup_logs:
                 # Write to file
                 self.stdout_logger.error(
                     'Could not send logs to Logz.io after %s tries, '
-                    'backing up to local file system', self.number_of_retries)
+                    'backing up to local file system', current_try)
                 backup_logs(logs_list, self.stdout_logger)
 
-            del logs_list
+    def _wait_before_retry(self, current_try):
+        # Exponential backoff, jittered so that senders failing together
+        # don't retry together
+        delay = min(self.retry_timeout * 2 ** (current_try - 1) *
+                    (0.5 + random()), MAX_RETRY_BACKOFF_IN_SECONDS)
+        retry_at = monotonic() + delay
+        if not self._closed.wait(delay):
+            return True
+
+        # Closed meanwhile, wait no longer than close()'s timeout allows
+        if self._close_deadline is not None:
+            retry_at = min(retry_at, self._close_deadline)
+        remaining = retry_at - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+        return self._close_deadline is None or \
+            monotonic() < self._close_deadline
 
-    def _get_messages_up_to_max_allowed_size(self):
+    def _handle_ok(self, response, logs_list, current_try):
+        self.stdout_logger.debug(
+            'Successfully sent bulk of %s logs to Logz.io!', len(logs_list))
+        return True
+
+    def _handle_bad_request(self, response, logs_list, current_try):
+        self.stdout_logger.info(
+            'Got 400 code from Logz.io. This means that some of your logs are '
+            'too big, or badly formatted. response: %s', response.text)
+        return True
+
+    def _handle_unauthorized(self, response, logs_list, current_try):
+        self.stdout_logger.info(
+            'You are not authorized with Logz.io! Token OK? dropping logs...')
+        return True
+
+    def _handle_retry(self, response, logs_list, current_try):
+        self.stdout_logger.info(
+            'Got %s while sending logs to Logz.io, Try (%s/%s). Response: %s',
+            response.status_code, current_try + 1, self.number_of_retries,
+            response.text)
+        return False
+
+    def _pop_queued_logs(self):
+        # Only the logs queued by now, the ones appended while sending will
+        # wake the sending thread again
+        logs = []
+        for _ in range(len(self.queue)):
+            try:
+                logs.append(self.queue.popleft())
+            except IndexError:
+                # Drained concurrently by flush()
+                break
+        return logs
+
+    def _get_bulks(self, logs):
         logs_list = []
         current_size = 0
-        while not self.queue.empty():
-            current_log = self.queue.get()
-            try:
-                current_size += sys.getsizeof(current_log)
-            except TypeError:
-                # pypy do not support sys.getsizeof
-                current_size += len(current_log) * 4
+        for current_log in logs:
+            # +1 for the new line separating the logs in the bulk
+            log_size = len(current_log) + 1
+            if logs_list and \
+                    current_size + log_size > MAX_BULK_SIZE_IN_BYTES:
+                yield logs_list
+                logs_list = []
+                current_size = 0
 
             logs_list.append(current_log)
-            if current_size >= MAX_BULK_SIZE_IN_BYTES:
-                break
-        return logs_list
+            current_size += log_size
+
+        if logs_list:
+            yield logs_list
@@ -18,7 +18,8 @@ setup(
         "protobuf>=3.20.2"
     ],
     extras_require={
-        "opentelemetry-logging": ["opentelemetry-instrumentation-logging==0.45b0"]
+        "opentelemetry-logging": ["opentelemetry-instrumentation-logging==0.45b0"],
+        "orjson": ["orjson>=3.0.0"]
     },
     test_requires=[
         "future"
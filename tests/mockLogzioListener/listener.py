@@ -1,5 +1,6 @@
 # noinspection PyUnresolvedReferences
 import future
+import gzip
 import socket
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
@@ -12,7 +13,10 @@ class ListenerHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         try:
             content_length = int(self.headers.get("Content-Length"))
-            all_logs = self.rfile.read(content_length).decode("utf-8").split('\n')
+            body = self.rfile.read(content_length)
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            all_logs = body.decode("utf-8").split('\n')
             if len(all_logs) == 0:
                 self._set_response(400, "Bad Request", b"Bad request you got there, pal")
                 return
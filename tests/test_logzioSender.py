@@ -1,9 +1,18 @@
+import datetime
+import decimal
 import fnmatch
+import json
 import logging.config
 import os
+import subprocess
+import sys
 import time
-from unittest import TestCase
+import uuid
+from threading import Timer
+from unittest import TestCase, skipIf
 
+from logzio.sender import (MAX_BULK_SIZE_IN_BYTES, CustomJSONEncoder,
+                           LogzioSender, json_dumps, orjson)
 from .mockLogzioListener import listener
 
 
@@ -18,6 +27,89 @@ def _find(pattern, path):
     return result
 
 
+# Forks before logging anything, then both processes exit right after queuing
+# a log, leaving it to the atexit hook to send
+_FORK_AND_EXIT_SCRIPT = """
+import os
+import sys
+
+from logzio.sender import LogzioSender
+
+logzio_sender = LogzioSender(
+    token="token", url=sys.argv[1], logs_drain_timeout=60)
+childpid = os.fork()
+if childpid == 0:
+    if not logzio_sender.sending_thread.is_alive():
+        os._exit(1)
+    logzio_sender.append({"message": "queued in child"})
+    sys.exit(0)
+
+_, status = os.waitpid(childpid, 0)
+logzio_sender.append({"message": "queued in parent"})
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+# The main thread returns right away, a non-daemon worker keeps logging
+_LOG_AFTER_MAIN_EXIT_SCRIPT = """
+import sys
+import time
+from threading import Thread
+
+from logzio.sender import LogzioSender
+
+logzio_sender = LogzioSender(
+    token="token", url=sys.argv[1], logs_drain_timeout=60)
+
+
+def log_from_worker():
+    # The first log after main exits used to be the sending thread's last
+    for counter in range(2):
+        time.sleep(1)
+        logzio_sender.append(
+            {"message": "logged after main exited " + str(counter)})
+    time.sleep(5)
+
+
+Thread(target=log_from_worker).start()
+"""
+
+
+class _DateTime(datetime.datetime):
+    pass
+
+
+class TestJSONEncoding(TestCase):
+    def setUp(self):
+        self.message = {
+            "datetime": datetime.datetime(2024, 1, 2, 3, 4, 5, 6),
+            "date": datetime.date(2024, 1, 2),
+            "uuid": uuid.UUID(int=1),
+            "decimal": decimal.Decimal("1.5"),
+            "datetime_subclass": _DateTime(2024, 1, 2, 3, 4, 5),
+        }
+        self.expected = {
+            "datetime": "2024-01-02T03:04:05.000006",
+            "date": "2024-01-02",
+            "uuid": "00000000-0000-0000-0000-000000000001",
+            "decimal": "1.5",
+            # Converted as a datetime, not as a date
+            "datetime_subclass": "2024-01-02T03:04:05",
+        }
+
+    def test_json_encoder(self):
+        self.assertEqual(
+            json.loads(json.dumps(self.message, cls=CustomJSONEncoder)),
+            self.expected)
+
+    @skipIf(orjson is None, "orjson is not installed")
+    def test_orjson_encoder(self):
+        self.assertEqual(json.loads(json_dumps(self.message)), self.expected)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            json_dumps({"object": object()})
+
+
 class TestLogzioSender(TestCase):
     def setUp(self):
         self.logzio_listener = listener.MockLogzioListener()
@@ -26,6 +118,8 @@ class TestLogzioSender(TestCase):
         self.logs_drain_timeout = 3
         self.retries_no = 4
         self.retry_timeout = 2
+        self.url = "http://" + self.logzio_listener.get_host() + ":" + \
+            str(self.logzio_listener.get_port())
 
         logging_configuration = {
             "version": 1,
@@ -43,7 +137,7 @@ class TestLogzioSender(TestCase):
                     "token": "token",
                     'logzio_type': "type",
                     'logs_drain_timeout': self.logs_drain_timeout,
-                    'url': "http://" + self.logzio_listener.get_host() + ":" + str(self.logzio_listener.get_port()),
+                    'url': self.url,
                     'debug': True,
                     'retries_no': self.retries_no,
                     'retry_timeout': self.retry_timeout
@@ -81,6 +175,113 @@ class TestLogzioSender(TestCase):
 
         self.assertEqual(self.logzio_listener.get_number_of_logs(), logs_num * 2)
 
+    def test_custom_encoder(self):
+        log_message = "Test custom encoder"
+        logzio_sender = LogzioSender(
+            token="token", url=self.url,
+            encoder=lambda message: json.dumps(
+                dict(message, encoded_by="custom")))
+        logzio_sender.append({"message": log_message})
+        logzio_sender.close()
+        self.assertTrue(self.logzio_listener.find_log(log_message))
+        self.assertTrue(
+            self.logzio_listener.find_log('"encoded_by": "custom"'))
+
+    @skipIf(orjson is None, "orjson is not installed")
+    def test_integer_beyond_64_bits(self):
+        self.logger.info("Test big integer", extra={"big_number": 2 ** 70})
+        time.sleep(self.logs_drain_timeout * 2)
+        self.assertTrue(self.logzio_listener.find_log(str(2 ** 70)))
+
+    def test_close_sends_queued_logs(self):
+        log_message = "Sent on close"
+        logzio_sender = self.logger.handlers[0].logzio_sender
+        self.logger.info(log_message)
+        logzio_sender.close()
+        self.assertFalse(logzio_sender.sending_thread.is_alive())
+        self.assertTrue(self.logzio_listener.find_log(log_message))
+
+    def test_bounded_queue_drops_oldest_logs(self):
+        logzio_sender = LogzioSender(
+            token="token", url=self.url, max_queue_size=2)
+        # Without a sending thread, the logs pile up until flushed
+        logzio_sender.close()
+        for counter in range(5):
+            logzio_sender.append({"message": "Bounded " + str(counter)})
+        logzio_sender.flush()
+
+        self.assertEqual(self.logzio_listener.get_number_of_logs(), 2)
+        self.assertTrue(self.logzio_listener.find_log("Bounded 3"))
+        self.assertTrue(self.logzio_listener.find_log("Bounded 4"))
+
+    def test_close_sends_logs_queued_after_last_try(self):
+        log_message = "Queued after the last try"
+        logzio_sender = LogzioSender(token="token", url=self.url)
+        logzio_sender.close()
+        logzio_sender.append({"message": log_message})
+        logzio_sender.close()
+        self.assertTrue(self.logzio_listener.find_log(log_message))
+
+    def test_log_from_worker_after_main_exit(self):
+        process = subprocess.Popen(
+            [sys.executable, "-c", _LOG_AFTER_MAIN_EXIT_SCRIPT, self.url])
+        try:
+            time.sleep(4)
+            # Sent while the worker is still running, not only at exit
+            self.assertIsNone(process.poll())
+            self.assertTrue(
+                self.logzio_listener.find_log("logged after main exited 0"))
+            self.assertTrue(
+                self.logzio_listener.find_log("logged after main exited 1"))
+        finally:
+            process.wait(timeout=60)
+
+    @skipIf(not hasattr(os, 'fork') or sys.version_info < (3, 9),
+            "needs os.fork and os.waitstatus_to_exitcode")
+    def test_fork_and_exit_send_queued_logs(self):
+        process = subprocess.run(
+            [sys.executable, "-c", _FORK_AND_EXIT_SCRIPT, self.url],
+            timeout=60)
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(self.logzio_listener.find_log("queued in child"))
+        self.assertTrue(self.logzio_listener.find_log("queued in parent"))
+
+    def test_close_timeout_bounds_retries(self):
+        logzio_sender = LogzioSender(
+            token="token", url=self.url, backup_logs=False,
+            number_of_retries=10, retry_timeout=60)
+        self.logzio_listener.set_server_error()
+        logzio_sender.append({"message": "Retried until closed"})
+        time.sleep(1)
+
+        start = time.time()
+        logzio_sender.close(timeout=1)
+        self.assertLess(time.time() - start, 5)
+        # One last try once the timeout is over
+        logzio_sender.sending_thread.join(5)
+        self.assertFalse(logzio_sender.sending_thread.is_alive())
+
+    def test_close_retries_transient_errors(self):
+        log_message = "Retried while closing"
+        logzio_sender = LogzioSender(
+            token="token", url=self.url, retry_timeout=1)
+        self.logzio_listener.set_server_error()
+        logzio_sender.append({"message": log_message})
+        time.sleep(0.5)
+
+        Timer(1, self.logzio_listener.clear_server_error).start()
+        logzio_sender.close()
+        self.assertTrue(self.logzio_listener.find_log(log_message))
+        self.assertEqual(len(_find("logzio-failures-*.txt", ".")), 0)
+
+    def test_oversized_log_dropped(self):
+        log_message = "Sent after oversized log"
+        self.logger.info("x" * MAX_BULK_SIZE_IN_BYTES)
+        self.logger.info(log_message)
+        time.sleep(self.logs_drain_timeout * 2)
+        self.assertEqual(self.logzio_listener.get_number_of_logs(), 1)
+        self.assertTrue(self.logzio_listener.find_log(log_message))
+
     def test_server_failure(self):
         log_message = "Failing log message"
         self.logzio_listener.set_server_error()